@@ -1,33 +1,150 @@
 import os
-from io import BytesIO
+import re
+import asyncio
+import hashlib
+import datetime
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from typing import Iterator
 import streamlit as st
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
-from PyPDF2 import PdfReader
-from zipfile import ZipFile
-from xml.etree.ElementTree import XML
-from langsmith import traceable
-from langsmith.wrappers import wrap_gemini
 
 load_dotenv()
 
-os.environ["LANGCHAIN_TRACING_V2"] = "true"
-os.environ["LANGCHAIN_API_KEY"] = os.getenv("LANGSMITH_API_KEY")
-
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
-traced_client = wrap_gemini(genai)
+# langsmith tracing is opt-in: LANGSMITH_TRACING=1 (or true) in the env / .env
+TRACE = os.getenv("LANGSMITH_TRACING", "0").lower() in ("1", "true")
+
+if TRACE:
+    from langsmith import traceable
+    from langsmith.wrappers import wrap_gemini
+
+    os.environ["LANGCHAIN_TRACING_V2"] = "true"
+    os.environ["LANGCHAIN_API_KEY"] = os.getenv("LANGSMITH_API_KEY", "")
+    traced_client = wrap_gemini(genai)
+else:
+    def traceable(f):
+        return f
+
+    traced_client = genai
 
 MODEL = "gemini-2.0-flash"
 
+def _get_model(system_prompt: str, cached_content: caching.CachedContent | None = None):
+    # pass the CachedContent object, not its name: a name makes the sdk GET it first
+    if cached_content:
+        return traced_client.GenerativeModel.from_cached_content(cached_content=cached_content)
+    return traced_client.GenerativeModel(MODEL, system_instruction=system_prompt)
+
 @traceable
-def call_gemini(system_prompt: str, user_prompt: str) -> str:
-    model = traced_client.GenerativeModel(MODEL, system_instruction=system_prompt)
-    resp = model.generate_content(user_prompt)
+def stream_gemini(system_prompt: str, user_prompt: str) -> Iterator[str]:
+    model = _get_model(system_prompt)
+    for chunk in model.generate_content(user_prompt, stream=True):
+        # finish-reason-only and safety-blocked chunks have no parts; .text raises on them
+        if chunk.parts:
+            yield chunk.text
+
+@traceable
+async def call_gemini_async(model, user_prompt: str) -> str:
+    resp = await model.generate_content_async(user_prompt)
     return resp.text
 
-def extract_text_from_pdf(uploaded_file) -> str:
-    reader = PdfReader(uploaded_file)
+CONTEXT_CACHE_TTL = datetime.timedelta(minutes=10)
+CONTEXT_CACHE_MIN_TOKENS = 2048
+
+def get_jd_context_cache(system_prompt: str, job_description: str) -> caching.CachedContent | None:
+    """
+    gemini context cache holding system prompt + jd, one per (prompt, jd) pair.
+    returns None without calling gemini when the pair is below the minimum
+    cacheable size. a failed create is remembered for one ttl, like a cache.
+    """
+    if approx_tokens(system_prompt + job_description) < CONTEXT_CACHE_MIN_TOKENS:
+        return None
+
+    key = hashlib.sha256(
+        (system_prompt + "\x00" + job_description).encode("utf-8")
+    ).hexdigest()
+    entry = st.session_state.get("jd_context_cache")
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if entry and entry["key"] == key and entry["expires"] > now:
+        return entry["cache"]
+
+    try:
+        cache = caching.CachedContent.create(
+            model=f"models/{MODEL}",
+            system_instruction=system_prompt,
+            contents=[f"job description:\n{job_description.strip()}"],
+            ttl=CONTEXT_CACHE_TTL,
+        )
+    except Exception:
+        cache = None
+
+    # renew a little early so a call never lands on an expired cache
+    st.session_state["jd_context_cache"] = {
+        "key": key,
+        "cache": cache,
+        "expires": now + CONTEXT_CACHE_TTL - datetime.timedelta(seconds=30),
+    }
+    return cache
+
+PDF_HEAVY_CONTENT_BYTES = 1_000_000
+PDF_HEAVY_MIN_CHARS = 200
+
+def _content_stream_length(page) -> int:
+    """
+    compressed size of the page's content streams, read from each stream's
+    /Length so nothing is inflated just to measure it.
+    """
+    doc = page.parent
+    total = 0
+    for xref in page.get_contents():
+        kind, value = doc.xref_get_key(xref, "Length")
+        if kind == "xref":
+            # indirect length, e.g. "12 0 R"
+            value = doc.xref_object(int(value.split()[0]), compressed=True)
+        try:
+            total += int(value.strip())
+        except ValueError:
+            total += len(doc.xref_stream_raw(xref))
+    return total
+
+def _pdf_page_text(page) -> str:
+    """
+    graphics-heavy pages (figures, infographic cvs) cost far more to walk than
+    the little text they hold: skip them outright when they use no fonts, and
+    drop what they yield when it is only a few labels.
+    """
+    if _content_stream_length(page) <= PDF_HEAVY_CONTENT_BYTES:
+        return page.get_text("text")
+    if not page.get_fonts():
+        return ""
+    text = page.get_text("text")
+    return text if len(text.strip()) >= PDF_HEAVY_MIN_CHARS else ""
+
+def extract_text_from_pdf(data: bytes) -> str:
+    """
+    pymupdf first (much faster), pypdf2 as fallback for pdfs fitz rejects.
+    """
+    import fitz
+
+    try:
+        doc = fitz.open(stream=data, filetype="pdf")
+    except fitz.FileDataError:
+        pass
+    else:
+        with doc:
+            return "\n".join(_pdf_page_text(page) for page in doc)
+
+    from PyPDF2 import PdfReader
+
+    reader = PdfReader(BytesIO(data))
     text = []
     for page in reader.pages:
         t = page.extract_text()
@@ -35,91 +152,347 @@ def extract_text_from_pdf(uploaded_file) -> str:
             text.append(t)
     return "\n".join(text)
 
-def extract_text_from_docx(uploaded_file) -> str:
+DOCX_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DOCX_P = DOCX_NS + "p"
+DOCX_T = DOCX_NS + "t"
+
+def extract_text_from_docx(data: bytes) -> str:
     """
-    minimal docx reader using only stdlib.
+    minimal docx reader: streams document.xml paragraph by paragraph with
+    lxml iterparse, clearing each one so the full tree is never built.
     """
-    data = uploaded_file.read()
+    from zipfile import ZipFile
+    from lxml import etree
+
     with ZipFile(BytesIO(data)) as docx_zip:
         xml_content = docx_zip.read("word/document.xml")
-    tree = XML(xml_content)
 
     paragraphs = []
-    ns = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
 
-    for paragraph in tree.iter(f"{ns}p"):
-        texts = [
-            node.text
-            for node in paragraph.iter(f"{ns}t")
-            if node.text
-        ]
-        if texts:
-            paragraphs.append("".join(texts))
+    context = etree.iterparse(BytesIO(xml_content), events=("end",), tag=DOCX_P)
+    for _, paragraph in context:
+        para_text = "".join(node.text for node in paragraph.iter(DOCX_T) if node.text)
+        if para_text:
+            paragraphs.append(para_text)
+        paragraph.clear()
 
     return "\n".join(paragraphs)
 
-def extract_text_from_file(uploaded_file) -> str:
+@st.cache_data(show_spinner=False)
+def extract_text_from_bytes(name: str, data: bytes) -> str:
     """
     supports: pdf, docx, txt.
     for .doc or unknown types: best-effort utf-8 decode.
+    streamlit hashes the bytes, so reruns skip re-parsing unchanged uploads.
     """
-    if uploaded_file is None:
-        return ""
-
-    name = uploaded_file.name.lower()
-    uploaded_file.seek(0)
+    name = name.lower()
 
     if name.endswith(".pdf"):
-        return extract_text_from_pdf(uploaded_file)
+        return extract_text_from_pdf(data)
     elif name.endswith(".docx"):
-        return extract_text_from_docx(uploaded_file)
+        return extract_text_from_docx(data)
     elif name.endswith(".txt"):
-        return uploaded_file.read().decode("utf-8", errors="ignore")
+        return data.decode("utf-8", errors="ignore")
     else:
         try:
-            return uploaded_file.read().decode("utf-8", errors="ignore")
+            return data.decode("utf-8", errors="ignore")
         except Exception:
             return ""
 
-SCREENING_SYSTEM_PROMPT = """
+def extract_text_from_file(uploaded_file) -> str:
+    if uploaded_file is None:
+        return ""
+    return extract_text_from_bytes(uploaded_file.name, uploaded_file.getvalue())
+
+CANDIDATE_SYSTEM_PROMPT = """
 you are an expert technical recruiter and hr specialist.
 your job:
-- evaluate multiple resumes against a single job description.
-- score each candidate from 0 to 10 based on fit.
+- evaluate one resume against a single job description.
+- score the candidate from 0 to 10 based on fit.
 - highlight strengths, concerns, and overall suitability.
 rules:
 - always consider only the given job description.
 - penalize resumes that are very generic or unrelated.
 - be fair and explain reasoning briefly.
 output format (exactly this structure):
+- candidate id: x
+- fit score: x/10
+- summary: ...
+- strengths:
+  - ...
+- concerns:
+  - ...
+- verdict (hire / strong maybe / maybe / reject):
+  - ...
+"""
+
+RANKING_SYSTEM_PROMPT = """
+you are an expert technical recruiter and hr specialist.
+your job:
+- you are given per-candidate evaluations, each already scored against the same job description.
+- compare them and rank the candidates.
+rules:
+- do not re-score; use the fit scores exactly as given.
+- break ties using the strengths and concerns listed.
+output format (exactly this structure):
 1. summary table:
    - a markdown table with columns:
      [candidate id, fit score (0-10), verdict]
-2. detailed breakdown per candidate:
-   for each candidate:
-   - candidate id: x
-   - fit score: x/10
-   - summary: ...
-   - strengths:
-     - ...
-   - concerns:
-     - ...
-   - verdict (hire / strong maybe / maybe / reject):
-     - ...
-3. final ranking:
+2. final ranking:
    - list candidates from best to worst with score.
 """
 
-def build_screening_prompt(job_description: str, candidates: list[str]) -> str:
-    text = [
-        "job description:\n",
-        job_description.strip(),
-        "\n\ncandidates:\n",
-    ]
-    for idx, cv in enumerate(candidates, start=1):
-        text.append(f"\n---\ncandidate {idx} resume:\n{cv.strip()}\n")
+def build_candidate_prompt(idx: int, cv: str, job_description: str | None = None) -> str:
+    """
+    job_description is left out when it already sits in the context cache.
+    """
+    text = []
+    if job_description is not None:
+        text += ["job description:\n", job_description.strip(), "\n\n"]
+    text.append(f"candidate {idx} resume:\n{cv.strip()}\n")
     return "".join(text)
 
+def build_ranking_prompt(evaluations: list[str]) -> str:
+    buf = StringIO()
+    buf.write("candidate evaluations:\n")
+    for evaluation in evaluations:
+        buf.write("\n---\n")
+        buf.write(evaluation.strip())
+        buf.write("\n")
+    return buf.getvalue()
+
+# pasted resumes are separated by a line of three or more dashes
+CANDIDATE_SPLIT_RE = re.compile(r"^-{3,}\s*$", re.M)
+
+MAX_CANDIDATE_TOKENS = 4000
+
+def approx_tokens(text: str) -> int:
+    """
+    rough gemini token estimate (~4 chars per token), no tokenizer round-trip.
+    """
+    return len(text) // 4
+
+def cap_to_token_budget(text: str, max_tokens: int = MAX_CANDIDATE_TOKENS) -> str:
+    if approx_tokens(text) <= max_tokens:
+        return text
+    return text[: max_tokens * 4]
+
+def _candidate_key(job_description: str, idx: int, cv: str) -> str:
+    # the candidate id is written into the evaluation, so it is part of the key
+    return hashlib.sha256(f"{job_description}\x00{idx}\x00{cv}".encode("utf-8")).hexdigest()
+
+SCORING_CONCURRENCY = 8
+SCORING_ATTEMPTS = 3
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+)
+
+# raised on calls through a context cache that expired or was deleted server-side
+CACHE_GONE_ERRORS = (
+    google_exceptions.NotFound,
+    google_exceptions.PermissionDenied,
+)
+
+async def _call_with_retry(model, prompt: str) -> str:
+    for attempt in range(SCORING_ATTEMPTS):
+        try:
+            return await call_gemini_async(model, prompt)
+        except RETRYABLE_ERRORS:
+            if attempt == SCORING_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+async def score_one(
+    model,
+    plain_model,
+    semaphore: asyncio.Semaphore,
+    job_description: str,
+    cv: str,
+    idx: int,
+    cache_lost: threading.Event | None,
+) -> str:
+    """
+    model reads the jd from the context cache when cache_lost is given; once
+    that cache is gone the candidate is rescored with the full prompt on
+    plain_model, and cache_lost tells the caller to drop the session entry.
+    """
+    async with semaphore:
+        if cache_lost is not None and not cache_lost.is_set():
+            try:
+                return await _call_with_retry(model, build_candidate_prompt(idx, cv))
+            except CACHE_GONE_ERRORS:
+                cache_lost.set()
+        return await _call_with_retry(plain_model, build_candidate_prompt(idx, cv, job_description))
+
+@st.cache_resource
+def _scoring_loop() -> asyncio.AbstractEventLoop:
+    """
+    one event loop for the whole process, on its own thread. the sdk caches its
+    grpc.aio client process-wide and that client stays bound to the loop it was
+    first used on, so a fresh asyncio.run() per click would break the second run.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="gemini-scoring", daemon=True).start()
+    return loop
+
+@st.cache_resource
+def _scoring_semaphore() -> asyncio.Semaphore:
+    # process-wide, so concurrent sessions share one cap against the api quota
+    return asyncio.Semaphore(SCORING_CONCURRENCY)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _evaluation(
+    candidate_key: str,
+    _job_description: str,
+    _idx: int,
+    _cv: str,
+    _model,
+    _plain_model,
+    _cache_lost: threading.Event | None,
+    _loop: asyncio.AbstractEventLoop,
+    _semaphore: asyncio.Semaphore,
+) -> str:
+    """
+    process-wide cache of per-candidate evaluations keyed on _candidate_key.
+    a failed call raises, so nothing is cached for it.
+    """
+    return asyncio.run_coroutine_threadsafe(
+        score_one(_model, _plain_model, _semaphore, _job_description, _cv, _idx, _cache_lost),
+        _loop,
+    ).result()
+
+def dedupe_candidates(candidates: list[str]) -> tuple[list[tuple[int, str]], dict[int, int]]:
+    """
+    drops resumes whose whitespace/case-normalized text was already seen.
+    returns the unique (candidate id, resume) pairs and a map of
+    duplicate candidate id -> id of the first copy.
+    """
+    seen = {}
+    unique = []
+    duplicates = {}
+    for idx, cv in enumerate(candidates, start=1):
+        normalized = " ".join(cv.split()).lower()
+        h = hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+        if h in seen:
+            duplicates[idx] = seen[h]
+        else:
+            seen[h] = idx
+            unique.append((idx, cv))
+    return unique, duplicates
+
+def score_candidates(
+    job_description: str, candidates: list[tuple[int, str]]
+) -> tuple[list[str], dict[int, str]]:
+    """
+    concurrent gemini calls per (candidate id, resume), at most
+    SCORING_CONCURRENCY in flight. evaluations are cached for an hour;
+    failures are not, so the next run retries them.
+    returns the evaluations in candidate order and candidate id -> error.
+    """
+    jd_cache = get_jd_context_cache(CANDIDATE_SYSTEM_PROMPT, job_description)
+    plain_model = _get_model(CANDIDATE_SYSTEM_PROMPT)
+    model = _get_model(CANDIDATE_SYSTEM_PROMPT, jd_cache) if jd_cache else plain_model
+    cache_lost = threading.Event() if jd_cache else None
+    loop, semaphore = _scoring_loop(), _scoring_semaphore()
+
+    # threads only wait on the cache / the scoring loop; the calls themselves are async
+    with ThreadPoolExecutor(max_workers=min(SCORING_CONCURRENCY, len(candidates)) or 1) as ex:
+        futures = [
+            ex.submit(
+                _evaluation,
+                _candidate_key(job_description, idx, cv),
+                job_description, idx, cv, model, plain_model, cache_lost, loop, semaphore,
+            )
+            for idx, cv in candidates
+        ]
+
+    if cache_lost is not None and cache_lost.is_set():
+        # the next run creates a fresh context cache instead of reusing a dead one
+        st.session_state.pop("jd_context_cache", None)
+
+    evaluations = []
+    failures = {}
+    for (idx, _), future in zip(candidates, futures):
+        try:
+            evaluations.append(future.result())
+        except Exception as exc:
+            failures[idx] = str(exc) or type(exc).__name__
+    return evaluations, failures
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _ranking_text(prompt_key: str, _prompt: str, _chunks: queue.Queue) -> str:
+    """
+    process-wide cache of finished rankings keyed on the prompt hash.
+    on a miss the stream is pushed chunk by chunk into _chunks as it arrives,
+    with the same backoff as scoring on quota / availability errors.
+    """
+    for attempt in range(SCORING_ATTEMPTS):
+        buf = []
+        try:
+            for chunk in stream_gemini(RANKING_SYSTEM_PROMPT, _prompt):
+                buf.append(chunk)
+                _chunks.put(chunk)
+            break
+        except RETRYABLE_ERRORS:
+            # chunks already shown cannot be taken back, so only retry before the first one
+            if buf or attempt == SCORING_ATTEMPTS - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+    text = "".join(buf)
+    if not text.strip():
+        # raising keeps an empty (e.g. safety-blocked) ranking out of the cache
+        raise ValueError("Gemini returned an empty ranking.")
+    return text
+
+def stream_ranking(evaluations: list[str]) -> Iterator[str]:
+    """
+    streams the ranking over the per-candidate evaluations; a ranking already
+    cached for the same evaluations is yielded in one piece.
+    """
+    prompt = build_ranking_prompt(evaluations)
+    key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    chunks = queue.Queue()
+
+    # the cached call runs on a worker so this generator can relay its chunks
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        future = ex.submit(_ranking_text, key, prompt, chunks)
+        future.add_done_callback(lambda _: chunks.put(None))
+        streamed = False
+        while (chunk := chunks.get()) is not None:
+            streamed = True
+            yield chunk
+        text = future.result()
+
+    if not streamed:
+        yield text
+
+def format_results(
+    ranking: str,
+    evaluations: list[str],
+    duplicates: dict[int, int],
+    failures: dict[int, str],
+) -> str:
+    sections = [ranking.strip()] if ranking.strip() else []
+    sections += [
+        "## detailed breakdown per candidate",
+        *[evaluation.strip() for evaluation in evaluations],
+    ]
+    if failures:
+        sections.append("## candidates not scored")
+        sections.append("\n".join(
+            f"- candidate {idx}: {error}" for idx, error in sorted(failures.items())
+        ))
+    if duplicates:
+        sections.append("## duplicate resumes")
+        sections.append("\n".join(
+            f"- candidate {idx}: same resume as candidate {first}, not scored separately."
+            for idx, first in duplicates.items()
+        ))
+    return "\n\n".join(sections)
+
 st.set_page_config(
     page_title="Resume Screening Agent",
     page_icon="",
@@ -187,16 +560,38 @@ extra_text_resumes = st.text_area(
 candidate_texts = []
 
 if uploaded_resumes:
-    for f in uploaded_resumes:
+    progress = st.progress(0.0, text="Extracting resume text...")
+    for done, f in enumerate(uploaded_resumes, start=1):
         text = extract_text_from_file(f)
         if text.strip():
             candidate_texts.append(text.strip())
+        progress.progress(done / len(uploaded_resumes), text="Extracting resume text...")
+    progress.empty()
 
 if extra_text_resumes.strip():
-    parts = [p.strip() for p in extra_text_resumes.split("---") if p.strip()]
+    parts = [p.strip() for p in CANDIDATE_SPLIT_RE.split(extra_text_resumes) if p.strip()]
     candidate_texts.extend(parts)
 
+# dedupe on the full text: resumes sharing a long common prefix must not merge
+unique_candidates, duplicate_candidates = dedupe_candidates(candidate_texts)
+
+truncated = [
+    idx
+    for idx, cv in unique_candidates
+    if approx_tokens(cv) > MAX_CANDIDATE_TOKENS
+]
+unique_candidates = [(idx, cap_to_token_budget(cv)) for idx, cv in unique_candidates]
+
 st.markdown(f"**Detected candidates:** {len(candidate_texts)}")
+if duplicate_candidates:
+    st.caption(
+        f"{len(duplicate_candidates)} duplicate resume(s) will be screened only once."
+    )
+if truncated:
+    st.caption(
+        f"⚠ Candidate(s) {', '.join(map(str, truncated))} exceed ~{MAX_CANDIDATE_TOKENS} tokens "
+        "and were truncated before screening."
+    )
 if len(candidate_texts) == 0:
     st.caption("Upload resumes and/or paste resume text to continue.")
 
@@ -212,14 +607,31 @@ if st.button("Screen Candidates"):
         st.warning("Please provide at least one candidate resume (file or text).")
     else:
         with st.spinner("Evaluating resumes against the job description..."):
-            user_prompt = build_screening_prompt(resolved_jd_text, candidate_texts)
-            result_text = call_gemini(SCREENING_SYSTEM_PROMPT, user_prompt)
-
-        st.session_state["result_text"] = result_text
-
-        st.success("Screening complete!")
-        st.markdown("## Results")
-        st.markdown(result_text)
+            evaluations, failures = score_candidates(resolved_jd_text, unique_candidates)
+
+        for idx, error in sorted(failures.items()):
+            st.error(f"Candidate {idx} could not be scored: {error}")
+
+        if not evaluations:
+            st.warning("No candidate could be scored. Please try again.")
+        else:
+            st.markdown("## Results")
+            placeholder = st.empty()
+            buf = []
+            try:
+                for chunk in stream_ranking(evaluations):
+                    buf.append(chunk)
+                    placeholder.markdown("".join(buf))
+                ranking = "".join(buf)
+            except Exception as exc:
+                st.error(f"Ranking could not be generated: {exc}")
+                ranking = ""
+
+            result_text = format_results(ranking, evaluations, duplicate_candidates, failures)
+            st.session_state["result_text"] = result_text
+
+            placeholder.markdown(result_text)
+            st.success("Screening complete!")
 
 if st.session_state["result_text"]:
     st.download_button(